@@ -363,9 +363,8 @@ class PatternComputer(object):
         self.model = model
 
         # Break cyclic import.
-        import innvestigate.analyzer.pattern_based
-        supported_layers = (
-            innvestigate.analyzer.pattern_based.SUPPORTED_LAYER_PATTERNNET)
+        from ..analyzer import pattern_based
+        supported_layers = pattern_based.SUPPORTED_LAYER_PATTERNNET
         for layer in self.model.layers:
             if not isinstance(layer, supported_layers):
                 raise Exception("Model contains not supported layer: %s"
@@ -13,7 +13,7 @@ from tensorflow.keras.utils import GeneratorEnqueuer
 from tensorflow.keras.utils import OrderedEnqueuer
 from tensorflow.keras.utils import Sequence
 
-from ... import utils as iutils
+from .. import utils as iutils
 
 
 class Perturbation:
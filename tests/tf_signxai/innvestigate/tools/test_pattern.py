@@ -8,17 +8,20 @@ from __future__ import\
 ###############################################################################
 
 
+import collections
+import functools
+
 import pytest
 
 import numpy as np
 import unittest
 
-from signxai.tf_signxai.innvestigate import backend
-from signxai.tf_signxai.innvestigate.utils.tests import cases
-from signxai.tf_signxai.innvestigate.utils.tests import dryrun
+from signxai.tf_signxai.methods.innvestigate import backend
+from signxai.tf_signxai.methods.innvestigate.utils.tests import cases
+from signxai.tf_signxai.methods.innvestigate.utils.tests import dryrun
 
-import signxai.tf_signxai.innvestigate
-from signxai.tf_signxai.innvestigate.tools import PatternComputer
+from signxai.tf_signxai.methods import innvestigate
+from signxai.tf_signxai.methods.innvestigate.tools import PatternComputer
 
 
 require_tf = pytest.mark.skipif(backend.name() != "tensorflow",
@@ -30,73 +33,31 @@ require_tf = pytest.mark.skipif(backend.name() != "tensorflow",
 ###############################################################################
 
 
-@require_tf
-@pytest.mark.fast
-@pytest.mark.precommit
-@pytest.mark.parametrize(
-    "case_id", ["dot", "mlp2", "mlp3", "cnn_2dim_c1_d1", "cnn_2dim_c2_d1"])
-def test_fast__PatternComputer_dummy_parallel(case_id):
-
-    case = getattr(cases, case_id)
+@pytest.fixture(scope="module")
+def case(request):
+    # PatternComputer builds its own models on top of the passed one and
+    # leaves it untouched, so each case is built once for all pattern types.
+    case = getattr(cases, request.param)
     if case is None:
         raise ValueError("Invalid case_id.")
 
-    model, data = case()
-    computer = PatternComputer(model, pattern_type="dummy",
-                               compute_layers_in_parallel=True)
-    computer.compute(data)
-
-
-###############################################################################
-###############################################################################
-###############################################################################
+    return case()
 
 
+# Layers are always computed in parallel, compute_layers_in_parallel=False
+# is not supported by the PatternComputer.
 @require_tf
 @pytest.mark.fast
 @pytest.mark.precommit
 @pytest.mark.parametrize(
-    "case_id", ["dot", "mlp2", "mlp3", "cnn_2dim_c1_d1", "cnn_2dim_c2_d1"])
-def test_fast__PatternComputer_linear(case_id):
-
-    case = getattr(cases, case_id)
-    if case is None:
-        raise ValueError("Invalid case_id.")
-
-    model, data = case()
-    computer = PatternComputer(model, pattern_type="linear")
-    computer.compute(data)
-
-
-@require_tf
-@pytest.mark.fast
-@pytest.mark.precommit
+    "case", ["dot", "mlp2", "mlp3", "cnn_2dim_c1_d1", "cnn_2dim_c2_d1"],
+    indirect=True)
 @pytest.mark.parametrize(
-    "case_id", ["dot", "mlp2", "mlp3", "cnn_2dim_c1_d1", "cnn_2dim_c2_d1"])
-def test_fast__PatternComputer_relupositive(case_id):
+    "pattern_type", ["dummy", "linear", "relu.positive", "relu.negative"])
+def test_fast__PatternComputer(case, pattern_type):
 
-    case = getattr(cases, case_id)
-    if case is None:
-        raise ValueError("Invalid case_id.")
-
-    model, data = case()
-    computer = PatternComputer(model, pattern_type="relu.positive")
-    computer.compute(data)
-
-
-@require_tf
-@pytest.mark.fast
-@pytest.mark.precommit
-@pytest.mark.parametrize(
-    "case_id", ["dot", "mlp2", "mlp3", "cnn_2dim_c1_d1", "cnn_2dim_c2_d1"])
-def test_fast__PatternComputer_relunegative(case_id):
-
-    case = getattr(cases, case_id)
-    if case is None:
-        raise ValueError("Invalid case_id.")
-
-    model, data = case()
-    computer = PatternComputer(model, pattern_type="relu.negative")
+    model, data = case
+    computer = PatternComputer(model, pattern_type=pattern_type)
     computer.compute(data)
 
 
@@ -111,28 +72,31 @@ def test_fast__PatternComputer_relunegative(case_id):
 class HaufePatternExample(unittest.TestCase):
 
     def test(self):
-        np.random.seed(234354346)
-        # need many samples to get close to optimum and stable numbers
-        n = 1000
+        rng = np.random.default_rng(234354346)
+        # need many samples to get close to optimum and stable numbers,
+        # with 1000 the pattern misses the tolerance for ~9% of the seeds
+        n = 10000
 
         a_s = np.asarray([1, 0]).reshape((1, 2))
         a_d = np.asarray([1, 1]).reshape((1, 2))
-        y = np.random.uniform(size=(n, 1))
-        eps = np.random.rand(n, 1)
+        y = rng.uniform(size=(n, 1))
+        eps = rng.random((n, 1))
 
         X = y * a_s + eps * a_d
 
         model = backend.keras.models.Sequential(
             [backend.keras.layers.Dense(1, input_shape=(2,), use_bias=True), ]
         )
-        model.compile(
-            optimizer=backend.keras.optimizers.Adam(lr=1), loss="mse")
-        model.fit(X, y, epochs=20, verbose=0).history
-        self.assertTrue(model.evaluate(X, y, verbose=0) < 0.05)
+        # set the least squares solution the regressor would converge to
+        Xb = np.hstack([X, np.ones((n, 1))])
+        W_ls = np.linalg.lstsq(Xb, y, rcond=None)[0]
+        model.set_weights([W_ls[:2], W_ls[2]])
+        self.assertTrue(np.mean((model.predict(X, verbose=0) - y) ** 2) < 0.05)
 
         pc = PatternComputer(model, pattern_type="linear")
-        A = pc.compute(X)[0]
-        W = model.get_weights()[0]
+        # one batch, so the sample size does not drive the number of steps
+        A = pc.compute(X, batch_size=n)[0]
+        W = model.layers[0].kernel.numpy()
 
         #print(a_d, model.get_weights()[0])
         #print(a_s, A)
@@ -151,17 +115,29 @@ class HaufePatternExample(unittest.TestCase):
 ###############################################################################
 
 
+MnistData = collections.namedtuple(
+    "MnistData", ["x_train", "y_train", "x_test", "y_test"])
+
+
+@functools.lru_cache(maxsize=1)
 def fetch_data():
     # the data, shuffled and split between train and test sets
     mnist = backend.keras.datasets.mnist
-    (x_train, y_train), (x_test, y_test) = mnist.load_mnist()
+    (x_train, y_train), (x_test, y_test) = mnist.load_data()
+    # only a few samples are used, preprocess just those
+    x_train, y_train = x_train[:100], y_train[:100]
+    x_test, y_test = x_test[:10], y_test[:10]
 
-    x_train = (x_train.reshape(60000, 1, 28, 28) - 127.5) / 127.5
-    x_test = (x_test.reshape(10000, 1, 28, 28) - 127.5) / 127.5
+    x_train = (x_train.reshape(-1, 1, 28, 28) - 127.5) / 127.5
+    x_test = (x_test.reshape(-1, 1, 28, 28) - 127.5) / 127.5
     x_train = x_train.astype('float32')
     x_test = x_test.astype('float32')
 
-    return x_train[:100], y_train[:100], x_test[:10], y_test[:10]
+    # the result is cached and shared between tests, hence read-only
+    data = MnistData(x_train, y_train, x_test, y_test)
+    for arr in data:
+        arr.setflags(write=False)
+    return data
 
 
 def create_model():
@@ -199,88 +175,77 @@ def train_model(model, data, epochs=20):
     model.evaluate(x_test, y_test, batch_size=batch_size, verbose=0)
 
 
-@require_tf
-@pytest.mark.fast
-@pytest.mark.precommit
-class MnistPatternExample_dense_linear(unittest.TestCase):
-
-    def test(self):
-        np.random.seed(234354346)
-
-        data = fetch_data()
-        model, modelp = create_model()
-        train_model(modelp, data, epochs=10)
-        model.set_weights(modelp.get_weights())
-
-        analyzer = innvestigate.create_analyzer("pattern.net", model,
-                                                pattern_type="linear")
-        analyzer.fit(data[0], batch_size=256, verbose=0)
-
-        patterns = analyzer._patterns
-        W = model.get_weights()[0]
-        W2D = W.reshape((-1, W.shape[-1]))
-        X = data[0].reshape((data[0].shape[0], -1))
-        Y = np.dot(X, W2D)
+@pytest.fixture(scope="module")
+def trained_model():
+    # training dominates the runtime, do it once for all pattern types
+    backend.keras.utils.set_random_seed(234354346)
 
-        def safe_divide(a, b):
-            return a / (b + (b == 0))
+    data = fetch_data()
+    model, modelp = create_model()
+    train_model(modelp, data, epochs=10)
+    model.set_weights(modelp.get_weights())
 
-        mean_x = X.mean(axis=0)
-        mean_y = Y.mean(axis=0)
-        mean_xy = np.dot(X.T, Y) / Y.shape[0]
-        ExEy = mean_x[:, None] * mean_y[None, :]
-        cov_xy = mean_xy - ExEy
-        w_cov_xy = np.diag(np.dot(W2D.T, cov_xy))
-        A = safe_divide(cov_xy, w_cov_xy[None, :])
-
-        def allclose(a, b):
-            return np.allclose(a, b, rtol=0.05, atol=0.05)
-        #print(A.sum(), patterns[0].sum())
-        self.assertTrue(allclose(A.ravel(), patterns[0].ravel()))
+    # inputs and outputs of the first dense layer are the same for all
+    # pattern types, they are shared read-only; its variables are read
+    # directly instead of copying all weights
+    dense = next(layer for layer in model.layers
+                 if isinstance(layer, backend.keras.layers.Dense))
+    W = dense.kernel.numpy()
+    b = dense.bias.numpy()
+    W2D = W.reshape((-1, W.shape[-1]))
+    X = data[0].reshape((data[0].shape[0], -1))
+    Y = X @ W2D
+    for arr in (W2D, b, Y):
+        arr.setflags(write=False)
+    return model, data, X, W2D, b, Y
 
 
 @require_tf
 @pytest.mark.fast
 @pytest.mark.precommit
-class MnistPatternExample_dense_relu(unittest.TestCase):
-
-    def test(self):
-        np.random.seed(234354346)
+@pytest.mark.parametrize("pattern_type", ["linear", "relu"])
+def test_fast__MnistPatternExample_dense(trained_model, pattern_type):
+    model, data, X, W2D, b, Y = trained_model
 
-        data = fetch_data()
-        model, modelp = create_model()
-        train_model(modelp, data, epochs=10)
-        model.set_weights(modelp.get_weights())
+    analyzer = innvestigate.create_analyzer("pattern.net", model,
+                                            pattern_type=pattern_type)
+    analyzer.fit(data[0], batch_size=256, verbose=0)
 
-        analyzer = innvestigate.create_analyzer("pattern.net", model,
-                                                pattern_type="relu")
-        analyzer.fit(data[0], batch_size=256, verbose=0)
-        patterns = analyzer._patterns
-        W, b = model.get_weights()[:2]
-        W2D = W.reshape((-1, W.shape[-1]))
-        X = data[0].reshape((data[0].shape[0], -1))
-        Y = np.dot(X, W2D)
+    patterns = analyzer._patterns
 
-        mask = np.dot(X, W2D) + b > 0
-        count = mask.sum(axis=0)
+    # keep the reference computation in float32 like the data
+    def safe_divide(a, b):
+        return a / np.where(b == 0, 1, b).astype(a.dtype)
 
-        def safe_divide(a, b):
-            return a / (b + (b == 0))
-
-        mean_x = safe_divide(np.dot(X.T, mask), count)
+    if pattern_type == "linear":
+        mean_x = X.mean(axis=0)
         mean_y = Y.mean(axis=0)
-        mean_xy = safe_divide(np.dot(X.T, Y * mask), count)
-
+        # With far fewer samples than features, contracting X.T with the
+        # narrow Y is cheaper than going through the (F, F) Gramian X.T @ X.
+        mean_xy = (X.T @ Y) / X.shape[0]
+        ExEy = mean_x[:, None] * mean_y[None, :]
+    else:
+        # same as Y + b > 0, without the temporary for Y + b
+        mask_bool = Y > -b
+        count = mask_bool.sum(axis=0).astype(X.dtype)
+        # cast once so both products below run as float GEMMs
+        mask = mask_bool.astype(X.dtype)
+
+        mean_x = safe_divide(X.T @ mask, count)
+        mean_y = Y.mean(axis=0)
+        # Y is shared with the other pattern types, mask a copy
+        mean_xy = safe_divide(X.T @ (Y * mask), count)
         ExEy = mean_x * mean_y
 
-        cov_xy = mean_xy - ExEy
-        w_cov_xy = np.diag(np.dot(W2D.T, cov_xy))
-        A = safe_divide(cov_xy, w_cov_xy[None, :])
+    cov_xy = mean_xy - ExEy
+    # only the diagonal of W2D.T @ cov_xy is needed
+    w_cov_xy = np.einsum("fc,fc->c", W2D, cov_xy)
+    A = safe_divide(cov_xy, w_cov_xy[None, :])
 
-        def allclose(a, b):
-            return np.allclose(a, b, rtol=0.05, atol=0.05)
-        #print(A.sum(), patterns[0].sum())
-        self.assertTrue(allclose(A.ravel(), patterns[0].ravel()))
+    def allclose(a, b):
+        return np.allclose(a, b, rtol=0.05, atol=0.05)
+    #print(A.sum(), patterns[0].sum())
+    assert allclose(A.ravel(), patterns[0].ravel())
 
 
 # def extract_2d_patches(X, conv_layer):